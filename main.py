@@ -1,14 +1,26 @@
 #!/usr/bin/env python3
-import os, time, json, requests, smtplib, traceback, threading, pytz
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import os, time, json, string, functools, requests, smtplib, traceback, threading
+import numpy as np
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
 from datetime import datetime, timezone, timedelta
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from google.cloud import storage
+from zoneinfo import ZoneInfo
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 # --- Global Status & Configuration ---
-AGENT_STATUS = "INITIALIZING"
-PROJECT_ID = os.getenv("GCP_PROJECT", "project-nexus-final") 
+# Status lives behind one dict slot: item assignment is a single atomic
+# reference swap, so the scheduler can write while HTTP threads read without
+# a lock (and without torn reads on free-threaded builds).
+_STATUS = {'v': "INITIALIZING"}
+
+def set_status(s): _STATUS['v'] = s
+
+def get_status(): return _STATUS['v']
+
+PROJECT_ID = os.getenv("GCP_PROJECT", "project-nexus-final")
 BUCKET_NAME = f"prometheus-data-library-{PROJECT_ID}"
 
 # --- Prometheus Core Configuration ---
@@ -20,85 +32,214 @@ TIMEZONE_STR = os.getenv('TIMEZONE', 'UTC')
 AGENT_VERSION = "v3.0 (Prometheus - Global Supremacy)"
 COINGECKO_API = 'https://api.coingecko.com/api/v3'
 DAILY_REPORT_TIME = "09:00"
+TARGET_HOUR, TARGET_MIN = map(int, DAILY_REPORT_TIME.split(':'))
 MAX_PRICE = 1.0
 CANDIDATE_COUNT = 250
 MINIMUM_SCORE_THRESHOLD = 50
 
 def now_utc(): return datetime.now(timezone.utc)
 
+# Shared session: pooled HTTPS connections (no per-call TLS handshake) plus
+# automatic backoff on 429/5xx, honoring CoinGecko's Retry-After header.
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=64, pool_maxsize=64,
+    max_retries=Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                      respect_retry_after_header=True)))
+
+_GCS_BUCKET = None
+
+def _get_gcs_bucket():
+    # google.cloud.storage drags in grpc/protobuf (hundreds of ms, large RSS),
+    # so it is imported on first upload rather than at cold start. Client
+    # construction still happens only once per process.
+    global _GCS_BUCKET
+    if _GCS_BUCKET is None:
+        from google.cloud import storage
+        _GCS_BUCKET = storage.Client().bucket(BUCKET_NAME)
+    return _GCS_BUCKET
+
 def save_analysis_to_gcs(data):
-    global AGENT_STATUS
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(BUCKET_NAME)
         today = now_utc().strftime('%Y-%m-%d')
         file_name = f"daily_analysis_{today}.json"
-        blob = bucket.blob(file_name)
-        blob.upload_from_string(json.dumps(data, indent=2), content_type='application/json')
+        blob = _get_gcs_bucket().blob(file_name)
+        blob.upload_from_string(orjson.dumps(data), content_type='application/json')
         print(f"[{now_utc()}] PrometheusLog: Successfully saved {file_name} to GCS.")
     except Exception as e:
-        AGENT_STATUS = f"ERROR: Failed to save analysis to GCS at {now_utc().isoformat()}"
+        set_status(f"ERROR: Failed to save analysis to GCS at {now_utc().isoformat()}")
         print(f"[{now_utc()}] FATAL ERROR: Could not write to GCS bucket '{BUCKET_NAME}'. Error: {e}")
 
+EMAIL_FROM = f"Project Prometheus <{EMAIL_SENDER}>"
+
+def build_directive_message(subject, html_body):
+    msg = EmailMessage()
+    msg['Subject'] = subject; msg['From'] = EMAIL_FROM; msg['To'] = EMAIL_RECEIVER
+    msg.set_content("This directive requires an HTML-capable mail client.")
+    msg.add_alternative(html_body, subtype='html')
+    return msg
+
 def send_email(subject, html_body):
     if not EMAIL_SENDER or not EMAIL_PASSWORD: return
-    msg = MIMEMultipart('alternative'); msg['Subject'] = subject; msg['From'] = f"Project Prometheus <{EMAIL_SENDER}>"; msg['To'] = EMAIL_RECEIVER
-    msg.attach(MIMEText(html_body, 'html', 'utf-8'))
+    msg = build_directive_message(subject, html_body)
     try:
         with smtplib.SMTP_SSL('smtp.gmail.com', 465) as s: s.login(EMAIL_SENDER, EMAIL_PASSWORD); s.send_message(msg)
     except Exception as e:
-        global AGENT_STATUS; AGENT_STATUS = f"ERROR: Email failed at {now_utc().isoformat()}"
+        set_status(f"ERROR: Email failed at {now_utc().isoformat()}")
+
+MARKET_CACHE_FILE = os.getenv('MARKET_CACHE_FILE', '/tmp/prometheus_market_cache.json')
+MARKET_CACHE_TTL = 3600  # seconds; survives restarts and dedupes same-day reruns
 
 def get_market_data():
+    try:
+        if os.path.exists(MARKET_CACHE_FILE) and time.time() - os.path.getmtime(MARKET_CACHE_FILE) < MARKET_CACHE_TTL:
+            with open(MARKET_CACHE_FILE) as f: return json.load(f)
+    except Exception: pass
     try:
         params = {'vs_currency': 'usd', 'order': 'market_cap_desc', 'per_page': CANDIDATE_COUNT, 'page': 1}
-        r = requests.get(f"{COINGECKO_API}/coins/markets", params=params, timeout=20); r.raise_for_status()
-        return [c for c in r.json() if c and c.get('current_price') and c.get('current_price') <= MAX_PRICE]
+        r = SESSION.get(f"{COINGECKO_API}/coins/markets", params=params, timeout=20); r.raise_for_status()
+        # Project to the fields the pipeline uses; the raw rows carry ~25 keys
+        # each and the list stays resident for the whole sentiment fan-out.
+        coins = [{'symbol': c.get('symbol',''), 'name': c.get('name',''),
+                  'market_cap': c.get('market_cap') or 1, 'total_volume': c.get('total_volume') or 1,
+                  'price_change_percentage_24h': c.get('price_change_percentage_24h') or 0,
+                  'current_price': c['current_price']}
+                 for c in r.json() if c and c.get('current_price') and c['current_price'] <= MAX_PRICE]
+        try:
+            with open(MARKET_CACHE_FILE, 'w') as f: json.dump(coins, f)
+        except Exception: pass
+        return coins
     except Exception as e:
-        global AGENT_STATUS; AGENT_STATUS = f"ERROR: CoinGecko fetch failed at {now_utc().isoformat()}"; return []
+        set_status(f"ERROR: CoinGecko fetch failed at {now_utc().isoformat()}"); return []
+
+SENTIMENT_WORKERS = 32  # capped to stay inside Pushshift rate limits
+SENTIMENT_BATCH_SIZE = 25
+
+def lru_cache_with_ttl(maxsize=512, ttl=3600):
+    """functools.lru_cache whose entries expire after ttl seconds."""
+    def decorator(func):
+        @functools.lru_cache(maxsize=maxsize)
+        def cached(ttl_bucket, *args): return func(*args)
+        @functools.wraps(func)
+        def wrapper(*args): return cached(int(time.time() // ttl), *args)
+        wrapper.cache_clear = cached.cache_clear
+        return wrapper
+    return decorator
+
+def fetch_sentiment_counts(candidates, session):
+    """Batch Pushshift lookups: one OR-joined aggregation query per chunk of coins.
+
+    Returns {lowercase name: count} for every term the responses cover; coins
+    missing from the result fall back to per-coin lookups in analyze_and_score."""
+    counts = {}
+    after = int((now_utc() - timedelta(days=1)).timestamp())
+    for i in range(0, len(candidates), SENTIMENT_BATCH_SIZE):
+        chunk = candidates[i:i+SENTIMENT_BATCH_SIZE]
+        try:
+            query = ' OR '.join(f'"{c.get("name","")}"' for c in chunk)
+            params = {'q': query, 'after': after, 'size': 0, 'aggs': 'q'}
+            r = session.get('https://api.pushshift.io/reddit/search/comment/', params=params, timeout=15)
+            if r.status_code != 200: continue
+            for bucket in r.json().get('aggs', {}).get('q', []):
+                counts[bucket.get('key', '').lower()] = bucket.get('doc_count', 0)
+        except Exception: continue
+    return counts
+
+@lru_cache_with_ttl(maxsize=512, ttl=3600)
+def _fetch_sentiment(symbol, name):
+    # Raises on failure so lru_cache never retains a failed lookup.
+    query = f'"{name}" OR "{symbol}"'; after = int((now_utc() - timedelta(days=1)).timestamp())
+    r = SESSION.get(f'https://api.pushshift.io/reddit/search/comment/?q={query}&after={after}&size=0&metadata=true', timeout=15)
+    if r.status_code != 200: raise RuntimeError(f"Pushshift returned {r.status_code}")
+    return r.json().get('metadata', {}).get('total_results', 0)
 
 def analyze_social_sentiment(symbol, name):
-    try:
-        query = f'"{name}" OR "{symbol}"'; after = int((now_utc() - timedelta(days=1)).timestamp())
-        r = requests.get(f'https://api.pushshift.io/reddit/search/comment/?q={query}&after={after}&size=0&metadata=true', timeout=15)
-        return r.json().get('metadata', {}).get('total_results', 0) if r.status_code == 200 else 0
+    try: return _fetch_sentiment(symbol.lower().strip(), name.lower().strip())
     except Exception: return 0
 
 def analyze_and_score(candidates):
+    batch_counts = fetch_sentiment_counts(candidates, SESSION)
+    def sentiment_for(c):
+        hit = batch_counts.get(c.get('name','').lower())
+        return hit if hit is not None else analyze_social_sentiment(c.get('symbol',''), c.get('name',''))
+    with ThreadPoolExecutor(max_workers=SENTIMENT_WORKERS) as ex:
+        sentiments = list(ex.map(sentiment_for, candidates))
+    n = len(candidates)
+    if not n: return []
+    sent = np.fromiter(sentiments, dtype=float, count=n)
+    mc = np.fromiter((c.get('market_cap') or 1 for c in candidates), dtype=float, count=n)
+    vol = np.fromiter((c.get('total_volume') or 1 for c in candidates), dtype=float, count=n)
+    chg = np.fromiter((c.get('price_change_percentage_24h') or 0 for c in candidates), dtype=float, count=n)
+    scores = np.minimum(sent * 0.5 + chg * 0.3 + (vol / mc) * 0.2, 99.9)
     scored_coins = []
-    for coin in candidates:
-        sentiment = analyze_social_sentiment(coin.get('symbol',''), coin.get('name',''))
-        mc=coin.get('market_cap',1) or 1; vol=coin.get('total_volume',1) or 1
-        chg24h=coin.get('price_change_percentage_24h', 0) or 0
-        score = (sentiment * 0.5) + (chg24h * 0.3) + ((vol/mc) * 0.2)
-        coin['score'] = min(score, 99.9)
-        scored_coins.append(coin)
-    return sorted(scored_coins, key=lambda x: x['score'], reverse=True)
+    for i in np.argsort(-scores, kind='stable'):
+        coin = candidates[i]; coin['score'] = float(scores[i]); scored_coins.append(coin)
+    return scored_coins
+
+try: LOCAL_TZ = ZoneInfo(TIMEZONE_STR)
+except Exception: LOCAL_TZ = ZoneInfo('UTC')
+REPORT_TEMPLATE = string.Template("""<html><body><h2>🔥 Prometheus Alpha Directive</h2><p><b>Date Issued:</b> ${local_time} | <b>Version:</b> ${version}</p><p><b>Coin:</b> ${name} (${symbol})</p><p><b>Score:</b> ${score}</p></body></html>""")
 
 def build_html_directive(coin):
-    try: local_tz = pytz.timezone(TIMEZONE_STR)
-    except Exception: local_tz = pytz.timezone('UTC')
-    local_time = now_utc().astimezone(local_tz).strftime('%Y-%m-%d %H:%M:%S %Z')
-    price = coin['price']
-    html = f"""<html><body><h2>🔥 Prometheus Alpha Directive</h2><p><b>Version:</b> {AGENT_VERSION}</p><p><b>Coin:</b> {coin['name']} ({coin['symbol'].upper()})</p><p><b>Score:</b> {coin['score']:.2f}</p></body></html>"""
-    return html
+    local_time = now_utc().astimezone(LOCAL_TZ).strftime('%Y-%m-%d %H:%M:%S %Z')
+    return REPORT_TEMPLATE.substitute(local_time=local_time, version=AGENT_VERSION,
+        name=coin['name'], symbol=coin['symbol'].upper(), score=f"{coin['score']:.2f}")
+
+STOP_EVENT = threading.Event()
+
+def next_report_time(now):
+    target = now.replace(hour=TARGET_HOUR, minute=TARGET_MIN, second=0, microsecond=0)
+    if target <= now: target += timedelta(days=1)
+    return target
 
 def prometheus_main_loop():
-    global AGENT_STATUS
-    AGENT_STATUS = f"Cognitive Core Started. Waiting for schedule at {DAILY_REPORT_TIME} UTC."
+    set_status(f"Cognitive Core Started. Waiting for schedule at {DAILY_REPORT_TIME} UTC.")
     last_report_date = None
-    while True:
+    fail_count = 0
+    while not STOP_EVENT.is_set():
         try:
             now = now_utc()
-            AGENT_STATUS = f"Cognitive Core is idle. Current time is {now.strftime('%H:%M:%S')} UTC. Waiting for {DAILY_REPORT_TIME} UTC."
-            if now.strftime('%H:%M') == DAILY_REPORT_TIME and now.date() != last_report_date:
-                AGENT_STATUS = f"Directive time reached! Initiating analysis at {now.isoformat()}"
-                last_report_date = now.date()
-                candidates = get_market_data()
-                if candidates:
-                    scored_list = analyze_and_score(candidates)
-                    save_analysis_to_gcs(scored_list)
-                    if scored_list and scored_list[0]['score'] > MINIMUM_SCORE_THRESHOLD:
-                        best_coin = scored_list[0]
-                        AGENT_STATUS = f"Analysis complete. Best coin: {best_coin['name']}. Sending directive."
-      
+            target = next_report_time(now)
+            if STOP_EVENT.wait(timeout=(target - now).total_seconds()):
+                break
+            now = now_utc()
+            if now.date() == last_report_date: continue  # spurious early wake; recompute target
+            set_status(f"Directive time reached! Initiating analysis at {now.isoformat()}")
+            last_report_date = now.date()
+            candidates = get_market_data()
+            if candidates:
+                scored_list = analyze_and_score(candidates)
+                save_analysis_to_gcs(scored_list)
+                if scored_list and scored_list[0]['score'] > MINIMUM_SCORE_THRESHOLD:
+                    best_coin = scored_list[0]
+                    set_status(f"Analysis complete. Best coin: {best_coin['name']}. Sending directive.")
+                    report_html = build_html_directive(best_coin)
+                    subject = f"🔥 Prometheus Alpha Directive: {best_coin['name']} ({best_coin['symbol'].upper()})"
+                    send_email(subject, report_html)
+                else:
+                    set_status(f"Analysis complete. No candidate met the minimum score of {MINIMUM_SCORE_THRESHOLD}. Directive withheld.")
+            else:
+                set_status("Analysis aborted. Market data synthesis returned no candidates.")
+            fail_count = 0
+        except Exception as e:
+            set_status(f"ERROR in main loop at {now_utc().isoformat()}")
+            print(f"[{now_utc()}] FATAL ERROR in main loop: {e}"); traceback.print_exc()
+            STOP_EVENT.wait(min(30 * 2 ** fail_count, 3600))
+            fail_count += 1
+
+class HealthCheckHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # lets liveness probes reuse the socket
+    def do_GET(self):
+        # Status timestamp is rendered per probe, not precomputed by the scheduler.
+        body = f"Prometheus Status: {get_status()} | Time: {now_utc().strftime('%H:%M:%S')} UTC | Next directive: {DAILY_REPORT_TIME} UTC".encode('utf-8')
+        self.send_response(200); self.send_header('Content-type','text/plain')
+        self.send_header('Content-Length', str(len(body))); self.send_header('Connection','keep-alive')
+        self.end_headers(); self.wfile.write(body)
+
+def run_health_check_server():
+    port=int(os.getenv("PORT", 8080)); server = ThreadingHTTPServer(('', port), HealthCheckHandler)
+    print(f"[{now_utc()}] PrometheusLog: Health check server active on port {port}.")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    scanner_thread = threading.Thread(target=prometheus_main_loop, daemon=True); scanner_thread.start()
+    run_health_check_server()